@@ -5,13 +5,22 @@ from urllib.parse import urlencode
 from datetime import datetime, timedelta, date
 import sys
 import os
+import re
+import argparse
+import threading
 from os.path import expanduser, join
 import math
 import json
+from concurrent.futures import ThreadPoolExecutor
 import locale # This ensures that lists with non-ASCII characters will still be properly sorted
 from calendar import day_name, day_abbr
 from PyUntisClasses import *
-from PyUntisSession import PyUntisSession
+from PyUntisPipeline import PyUntisPipeline
+from PyUntisDelta import PyUntisManifest
+from PyUntisProfiler import PyUntisProfiler
+
+# PyUntisSession (which imports requests), PyUntisStore and PyUntisServer are only imported where they're needed,
+# so quick invocations like --help don't have to wait for them.
 
 # Modified from http://stackoverflow.com/questions/1060279/iterating-through-a-range-of-dates-in-python
 def daterange(start_date, end_date):
@@ -45,6 +54,356 @@ def load_teachers_from_file(f):
 
 		return [PyUntisTeacher(t) for t in t_list]
 
+# Splits a date range into consecutive chunks of at most chunk_weeks weeks.
+# Both dates are expected to already be clamped to the current schoolyear.
+def date_chunks(start_date, end_date, chunk_weeks):
+	chunk_start = start_date.date
+	while chunk_start <= end_date.date:
+		chunk_end = min(chunk_start + timedelta(days = chunk_weeks * 7 - 1), end_date.date)
+		yield PyUntisDate(date=chunk_start), PyUntisDate(date=chunk_end)
+		chunk_start = chunk_end + timedelta(days = 1)
+
+# Plans are generated by a pipeline of five stages:
+# fetch → parse → group → serialize → publish
+# Each stage runs in its own thread and passes its items on through a bounded queue,
+# so a plan's JSON is released as soon as its file has been written.
+# Class plans are passed on as soon as their class has been fetched. Only teacher and room plans
+# have to wait for all classes, so their lessons are kept as compact lesson records until then.
+
+# Fetch stage: requests the raw lessons of all given classes in date chunks,
+# with up to `workers` requests in flight, and yields (class, raw entries) once all chunks of a class are in.
+# Every lesson belongs to at least one class, so this can't miss any lessons the way fetching by teachers or rooms would.
+def fetch_stage(session, classes, chunks, workers, profiler):
+	def fetch(kl, chunk_start, chunk_end):
+		box_print("║   ║", "Requesting timetables for {0} ({1}-{2})…".format(kl, chunk_start.untis_date, chunk_end.untis_date))
+
+		with profiler.phase("fetch:{0}".format(kl)):
+			return session.getTimetableRaw(kl.id, PyUntisElementType.CLASS,
+				start_date = chunk_start.untis_date, end_date = chunk_end.untis_date,
+				showInfo = True, showSubstText = True, showLsText = True, showLsNumber = True, showStudentgroup = True)
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		# Only keep a limited number of responses around that haven't been parsed yet
+		def results():
+			in_flight = []
+			for kl in classes:
+				for chunk_index, (chunk_start, chunk_end) in enumerate(chunks):
+					in_flight.append((kl, chunk_index == len(chunks) - 1, executor.submit(profiler.profiled(fetch), kl, chunk_start, chunk_end)))
+					if len(in_flight) >= workers * 2:
+						yield in_flight.pop(0)
+
+			yield from in_flight
+
+		raw_entries = []
+		for kl, last_chunk, future in results():
+			raw_entries += future.result()
+			if last_chunk:
+				yield kl, raw_entries
+				raw_entries = []
+
+# Plans are built from compact lesson records of (date, start time, lesson JSON) instead of PyUntisTimetableEntry objects,
+# so each lesson's JSON is only built once, no matter how many plans it's in.
+def make_lesson_record(entry):
+	return entry.date.untis_date, entry.start_time.untis_time, entry.to_json()
+
+# Parse stage: turns each class's raw entries into lesson records and records new lessons in the store, if there is one.
+# Lessons shared by several classes are only parsed once. Their records are kept until the last of their classes
+# has come through, so at most the shared lessons of classes that haven't been fetched yet are held here.
+# Yields (class, lesson records, new lessons) where new lessons are (record, PyUntisTimetableEntry) tuples
+# of the lessons that weren't in any earlier class.
+def parse_stage(class_entries, classes, profiler, store_run=None):
+	pending_class_ids = set(kl.id for kl in classes)
+	shared_records = {}
+	seen_ids = set()
+
+	for kl, raw_entries in class_entries:
+		pending_class_ids.discard(kl.id)
+		records, new_lessons, new_raw_entries = [], [], []
+
+		with profiler.phase("parse"):
+			for raw_entry in dict((raw_entry["id"], raw_entry) for raw_entry in raw_entries).values():
+				lesson_id = raw_entry["id"]
+				if lesson_id in shared_records:
+					record, remaining_class_ids = shared_records[lesson_id]
+					remaining_class_ids.discard(kl.id)
+					if not remaining_class_ids:
+						del shared_records[lesson_id]
+				else:
+					entry = PyUntisTimetableEntry(raw_entry)
+					record = make_lesson_record(entry)
+
+					remaining_class_ids = pending_class_ids.intersection(el.id for el in entry.classes)
+					if remaining_class_ids:
+						shared_records[lesson_id] = record, remaining_class_ids
+
+					if lesson_id not in seen_ids:
+						seen_ids.add(lesson_id)
+						new_lessons.append((record, entry))
+						new_raw_entries.append(raw_entry)
+
+				records.append(record)
+
+		if store_run:
+			with profiler.phase("store"):
+				for raw_entry in new_raw_entries:
+					store_run.add_lesson(raw_entry)
+
+		yield kl, records, new_lessons
+
+# Group stage: passes each class's plan on right away and indexes new lessons by teacher and room.
+# Teacher and room plans are only complete once all classes are in, so their lesson records are held
+# until then. Each plan's records are dropped from the index as soon as it has been passed on.
+# Yields tuples of (plan file name, lesson records, substitutions, additional JSON).
+def group_stage(class_lessons, substitutions, profiler, derived_plans=True, exams=None, teacher_names=None):
+	indexes = {"teachers": {}, "rooms": {}}
+	element_names = {"teachers": {}, "rooms": {}, "subjects": {}}
+
+	with profiler.phase("group"):
+		class_substitutions = partition_entries(substitutions, "classes")
+		class_exams = index_exams(exams) if exams is not None else None
+
+	# Teachers loaded from a file have string IDs, while exams refer to them by number
+	teacher_names = {int(teacher_id): name for teacher_id, name in (teacher_names or {}).items()}
+	exam_jsons = {}
+
+	for kl, records, new_lessons in class_lessons:
+		# Only the indexing itself is timed, not waiting for the earlier stages to pass lessons on
+		with profiler.phase("group:index"):
+			for record, entry in new_lessons:
+				for attr, index in indexes.items():
+					for element_id in dict.fromkeys(el.id for el in getattr(entry, attr)):
+						index.setdefault(element_id, []).append(record)
+
+				for attr, names in element_names.items():
+					for el in getattr(entry, attr):
+						names[el.id] = el.name
+
+			extra_json = {}
+			if class_exams is not None:
+				# Each exam is turned into JSON once, when the first of its classes comes through.
+				# Subject names are taken from the lessons, so they're complete for the class's own subjects.
+				for exam in class_exams.get(kl.id, []):
+					if exam not in exam_jsons:
+						exam_jsons[exam] = exam.to_json(element_names["subjects"], teacher_names)
+
+				extra_json["exams"] = [exam_jsons[exam] for exam in class_exams.get(kl.id, [])]
+
+		yield "{0}.json".format(kl.id), records, class_substitutions.get(kl.id, []), extra_json
+
+	if not derived_plans:
+		return
+
+	# Teacher and room plans are built by re-indexing the lessons we already have.
+	# Substitutions are also listed for the teacher or room they were moved away from.
+	for plan_subdir, attr in [("teacher", "teachers"), ("room", "rooms")]:
+		element_timetables = indexes.pop(attr)
+		with profiler.phase("group"):
+			element_substitutions = partition_entries(substitutions, attr, include_original=True)
+
+		for element_id in sorted(element_timetables.keys() | element_substitutions.keys()):
+			yield (join(plan_subdir, "{0}.json".format(element_id)), element_timetables.pop(element_id, []),
+				element_substitutions.get(element_id, []), {"name": element_names[attr].get(element_id)})
+
+# Serialize stage: builds each plan's JSON and encodes it.
+# If only a part of the plan window was fetched (merge_range), the rest of each plan is taken from its existing file.
+def serialize_stage(plans, calendar, has_substitutions, substitutions_denied, profiler, merge_range=None, plan_dir=None):
+	for plan_file_name, timetable, plan_substitutions, extra_json in plans:
+		with profiler.phase("serialize"):
+			timetable_json = build_timetable_json(timetable, plan_substitutions, has_substitutions, substitutions_denied, calendar)
+			timetable_json.update(extra_json)
+
+			if merge_range:
+				old_data = read_plan_file(plan_dir, plan_file_name)
+				timetable_json = merge_timetable_json(json.loads(old_data), timetable_json, calendar, *merge_range) if old_data else None
+				if timetable_json is None:
+					box_print("║   ║", "Can't update {0}, regenerate it completely first.".format(plan_file_name))
+					continue
+
+			plan_data = json.dumps(timetable_json, ensure_ascii=False).encode("utf-8")
+
+		yield plan_file_name, plan_data, timetable_json
+
+# Publish stage: writes each changed plan to the plan directory,
+# along with a delta to its previously published version.
+# Plans that didn't change at all are left alone.
+# If given, publish(file_name, data) is called for every plan and delta, whether it changed or not.
+def publish_stage(plan_files, plan_dir, manifest, profiler, publish=None):
+	for plan_file_name, plan_data, timetable_json in plan_files:
+		with profiler.phase("delta"):
+			old_data = read_plan_file(plan_dir, plan_file_name)
+			version, delta_files = manifest.update(plan_file_name, plan_data, timetable_json, old_data)
+
+			# The version goes first, so clients can tell which version of the plan they got
+			plan_data = b'{"version": %d, ' % version + plan_data[1:]
+
+		with profiler.phase("write"):
+			for delta_file_name, delta_data in delta_files:
+				write_plan_file(plan_dir, delta_file_name, delta_data)
+
+			if plan_data != old_data:
+				write_plan_file(plan_dir, plan_file_name, plan_data)
+
+		if publish:
+			with profiler.phase("publish"):
+				for delta_file_name, delta_data in delta_files:
+					publish(delta_file_name, delta_data)
+
+				publish(plan_file_name, plan_data)
+
+		yield plan_file_name
+
+# Fetches the school's substitutions for all date chunks at once.
+# Errors are raised just like they would be for a single getSubstitutions call.
+def fetch_substitutions(session, chunks, workers, profiler, store_run=None):
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(profiler.profiled(session.getSubstitutionsRaw), start_date = chunk_start.untis_date, end_date = chunk_end.untis_date) for chunk_start, chunk_end in chunks]
+
+		substitutions = []
+		for future in futures:
+			for raw_subst in future.result():
+				if store_run:
+					store_run.add_substitution(raw_subst)
+
+				substitutions.append(PyUntisSubstitution(raw_subst))
+
+		return substitutions
+
+# Fetches the exams of every exam type. WebUntis returns the exams of all classes at once,
+# so this only takes one request per exam type and chunk instead of one per class.
+def fetch_exams(session, chunks, workers, profiler):
+	exam_types = session.getExamTypes()
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(profiler.profiled(session.getExams), exam_type, chunk_start.untis_date, chunk_end.untis_date)
+			for exam_type in exam_types for chunk_start, chunk_end in chunks]
+
+		exams = [exam for future in futures for exam in future.result()]
+
+	return sorted(exams, key=lambda exam: (exam.date, exam.start_time))
+
+# Indexes exams by the IDs of their classes
+def index_exams(exams):
+	class_exams = {}
+	for exam in exams:
+		for class_id in dict.fromkeys(exam.class_ids):
+			class_exams.setdefault(class_id, []).append(exam)
+
+	return class_exams
+
+# Indexes lessons or substitutions by the IDs of their classes, teachers or rooms.
+# With include_original, substitutions are also indexed by the teacher or room they replaced.
+def partition_entries(entries, attr, include_original=False):
+	partitioned = {}
+	for entry in entries:
+		element_ids = []
+		for el in getattr(entry, attr):
+			element_ids.append(el.id)
+			if include_original and getattr(el, "original_id", None):
+				element_ids.append(el.original_id)
+
+		# dict.fromkeys removes duplicate IDs while keeping their order
+		for element_id in dict.fromkeys(element_ids):
+			partitioned.setdefault(element_id, []).append(entry)
+
+	return partitioned
+
+# Builds the JSON plan for a single class, teacher or room from its lesson records and substitutions.
+# Everything that's the same for all plans of a school comes from the precomputed calendar.
+def build_timetable_json(timetable, plan_substitutions, has_substitutions, substitutions_denied, calendar):
+	# Group lessons by day once instead of scanning the whole timetable for every day
+	lessons_by_date = {}
+	for untis_date, untis_time, lesson_json in timetable:
+		lessons_by_date.setdefault(untis_date, []).append((untis_time, lesson_json))
+
+	timetable_json = {}
+	timetable_json["firstDay"] = calendar.first_day_json
+	timetable_json["weeks"] = [[] for x in range(calendar.weeks)]
+
+	for day in calendar.days:
+		day_json = {}
+
+		if day.holiday:
+			# append holiday to week
+			day_json["holiday"] = calendar.holiday_json[day.date.untis_date]
+			timetable_json["weeks"][day.week_index].append(day_json)
+			continue # this is a holiday, skip it
+
+		day_lessons = sorted(lessons_by_date.get(day.date.untis_date, []), key=lambda l: int(l[0]))
+
+		for untis_time, lesson_json in day_lessons:
+			# note for later: test.sort(function(a, b) { return a.localeCompare(b);})
+			day_json.setdefault(untis_time, []).append(lesson_json)
+
+		timetable_json["weeks"][day.week_index].append(day_json)
+
+	if has_substitutions:
+		timetable_json["substitutions"] = []
+		for subst in plan_substitutions:
+			subst_json = subst.to_json()
+			if subst_json:
+				timetable_json["substitutions"].append(subst_json)
+	else:
+		timetable_json["substitutionDenied"] = substitutions_denied
+
+	return timetable_json
+
+# Replaces the days and substitutions between start_date and end_date in an existing plan with those of a new one.
+# Returns None if the plans don't cover the same days.
+def merge_timetable_json(old_json, new_json, calendar, start_date, end_date):
+	if old_json.get("firstDay") != new_json["firstDay"] or [len(w) for w in old_json.get("weeks", [])] != [len(w) for w in new_json["weeks"]]:
+		return None
+
+	for day in calendar.days:
+		if not (start_date <= day.date <= end_date):
+			new_json["weeks"][day.week_index][day.day_index] = old_json["weeks"][day.week_index][day.day_index]
+
+	in_range = lambda entry: start_date.untis_date <= entry["date"] <= end_date.untis_date
+	for key in ["substitutions", "exams"]:
+		if key in new_json and key in old_json:
+			kept_entries = [entry for entry in old_json[key] if not in_range(entry)]
+			new_entries = [entry for entry in new_json[key] if in_range(entry)]
+			new_json[key] = sorted(kept_entries + new_entries, key=lambda entry: (entry["date"], int(entry["time"])))
+		elif key in old_json:
+			# These couldn't be fetched this time, so the old ones are kept
+			new_json[key] = old_json[key]
+
+	if "substitutions" in new_json:
+		new_json.pop("substitutionDenied", None)
+
+	return new_json
+
+def read_plan_file(plan_dir, plan_file_name):
+	try:
+		with open(join(plan_dir, plan_file_name), mode="rb") as plan_file:
+			return plan_file.read()
+	except FileNotFoundError:
+		return None
+
+# Plan files are replaced atomically so displays never see a half-written file
+def write_plan_file(plan_dir, plan_file_name, plan_data):
+	plan_path = join(plan_dir, plan_file_name)
+	os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+
+	with open(plan_path + ".tmp", mode="wb") as plan_file:
+		plan_file.write(plan_data)
+
+	os.replace(plan_path + ".tmp", plan_path)
+	box_print("║   ║", "{0} written.".format(plan_file_name), "right")
+
+# Returns a function that turns names into locale-aware sort keys.
+# Uses PyICU if it's installed, otherwise falls back to a regular case-insensitive sort.
+def make_sort_key(school_locale):
+	try:
+		import icu
+		collator = icu.Collator.createInstance(icu.Locale(school_locale))
+		return lambda name: collator.getSortKey(name.lower())
+	except ImportError:
+		box_print("║   ║", "Install PyICU for better list sorting.")
+		return lambda name: name.lower()
+
+# Lines are printed from several threads at once, this keeps them from running into each other
+box_print_lock = threading.Lock()
+
 # len(box_chars) MUST be an odd number
 # "╔╦═╦╗" is a valid box_chars string, for example
 # 0 is left, 1 is center, 2 is right
@@ -74,11 +433,27 @@ def box_print(box_chars, input_str="", align="left"):
 	else:
 		raise ValueError("align must either be \"left\", \"center\" or \"right\".")
 
-	print(chars_start + transformed_str + chars_end)
+	with box_print_lock:
+		print(chars_start + transformed_str + chars_end)
+
+# Generates all files of a school.
+# If given, publish(file_name, data) is called for every file that's generated, e.g. to serve it from memory.
+# If given, the profiler records how long each phase took.
+# class_ids and date_range (a tuple of two PyUntisDates, either of which can be None to leave that end open) limit the run to some classes and days.
+# Such targeted runs reuse the master data cached by the last full run and only update the affected plan files.
+def handle_school(school, defaults, session, publish=None, profiler=None, class_ids=None, date_range=None):
+	profiler = profiler or PyUntisProfiler()
+	targeted = class_ids is not None or date_range is not None
 
-def handle_school(school, defaults, session):
 	box_print("╠═╣", school["displayName"] if "displayName" in school else school["name"], "center")
 
+	# Checked before anything is requested, since both are needed to compute the plan window
+	weeks = school.get("weeks", defaults["weeks"])
+	chunk_weeks = school.get("chunkWeeks", defaults["chunkWeeks"])
+	for option_name, option_value in [("weeks", weeks), ("chunkWeeks", chunk_weeks)]:
+		if not isinstance(option_value, int) or option_value < 1:
+			raise ValueError("{0} must be a whole number of at least 1, not {1!r}.".format(option_name, option_value))
+
 	plan_dir = expanduser(school["planDir"])
 	os.makedirs(plan_dir, exist_ok=True)
 
@@ -89,16 +464,18 @@ def handle_school(school, defaults, session):
 	except:
 		box_print("║   ║", f"Unsupported locale {school_locale}.")
 
-	try:
-		import icu
-		collator = icu.Collator.createInstance(icu.Locale(school_locale))
-	except ImportError:
-		box_print("║   ║", "Install PyICU for better list sorting.")
+	sort_key = make_sort_key(school_locale)
+
+	master_cache_path = join(plan_dir, ".cache", "master.json")
+	session.load_master_cache(master_cache_path)
+	session.use_master_cache = targeted
 
 	if "server" not in school:
 		box_print("║   ║", "Looking for school and authenticating…")
 
-		results = session.searchSchools(school["name"])
+		with profiler.phase("search"):
+			results = session.searchSchools(school["name"])
+
 		if len(results) < 1:
 			box_print("║   ║", "Can't find school. Skipping.")
 			return
@@ -109,7 +486,8 @@ def handle_school(school, defaults, session):
 		auth_school = PyUntisSchool(school.get("displayName"), school["name"], "", school["server"])
 
 	try:
-		auth = session.authenticate(auth_school, school["username"], school["password"] if "password" in school else None)
+		with profiler.phase("authenticate"):
+			auth = session.authenticate(auth_school, school["username"], school["password"] if "password" in school else None)
 	except PyUntisAuthError:
 		box_print("║   ║", "Invalid login credentials.")
 		return
@@ -128,40 +506,33 @@ def handle_school(school, defaults, session):
 	meta_long = "{0},<br>{1}"
 	meta_short = "{0}.,<br>{1}"
 
-	# Get the first days of this week and the next two weeks
-	week1_mon = get_other_weekday(weekday_index = 0, week_index = 0)
-	week2_mon = get_other_weekday(weekday_index = 0, week_index = 1)
-	week3_mon = get_other_weekday(weekday_index = 0, week_index = 2)
+	# Get the first days of this week and the following weeks
+	week_mondays = [get_other_weekday(weekday_index = 0, week_index = w) for w in range(weeks)]
 
 	# Add date display formats to meta object
 	meta["weekDatesLong"] = []
 	meta["weekDatesShort"] = []
-	meta["weekDatesLong"].append([meta_long.format(day_name[w], (week1_mon.date + timedelta(days = w)).strftime("%d.%m.%Y")) for w in range(0,5)])
-	meta["weekDatesLong"].append([meta_long.format(day_name[w], (week2_mon.date + timedelta(days = w)).strftime("%d.%m.%Y")) for w in range(0,5)])
-	meta["weekDatesLong"].append([meta_long.format(day_name[w], (week3_mon.date + timedelta(days = w)).strftime("%d.%m.%Y")) for w in range(0,5)])
-	meta["weekDatesShort"].append([meta_short.format(day_abbr[w], (week1_mon.date + timedelta(days = w)).strftime("%d.%m.")) for w in range(0,5)])
-	meta["weekDatesShort"].append([meta_short.format(day_abbr[w], (week2_mon.date + timedelta(days = w)).strftime("%d.%m.")) for w in range(0,5)])
-	meta["weekDatesShort"].append([meta_short.format(day_abbr[w], (week3_mon.date + timedelta(days = w)).strftime("%d.%m.")) for w in range(0,5)])
+	for week_mon in week_mondays:
+		meta["weekDatesLong"].append([meta_long.format(day_name[w], (week_mon.date + timedelta(days = w)).strftime("%d.%m.%Y")) for w in range(0,5)])
+		meta["weekDatesShort"].append([meta_short.format(day_abbr[w], (week_mon.date + timedelta(days = w)).strftime("%d.%m.")) for w in range(0,5)])
 
 	# Add school year information to meta object
 	box_print("║   ║", "Requesting school year information…")
-	current_schoolyear = session.getCurrentSchoolyear()
+	with profiler.phase("meta:getCurrentSchoolyear"):
+		current_schoolyear = session.getCurrentSchoolyear()
 	meta["currentSchoolyear"] = current_schoolyear.to_json()
 
 	# Add holiday information to meta object
 	box_print("║   ║", "Requesting holiday information…")
-	holidays = session.getHolidays()
+	with profiler.phase("meta:getHolidays"):
+		holidays = session.getHolidays()
 	meta["holidays"] = [h.to_json() for h in holidays]
 
 	# Add school classes and IDs to meta object
 	box_print("║   ║", "Requesting class information…")
-	classes = session.getKlassen()
-	try:
-		# PyICU is available
-		classes_sorted = sorted(classes, key=lambda kl: collator.getSortKey(kl.name.lower()))
-	except NameError:
-		# PyICU is not installed, fallback to regular sort
-		classes_sorted = sorted(classes, key=lambda kl: kl.name.lower())
+	with profiler.phase("meta:getKlassen"):
+		classes = session.getKlassen()
+	classes_sorted = sorted(classes, key=lambda kl: sort_key(kl.name))
 
 	meta["classes"] = {
 		"names": [kl.name for kl in classes_sorted],
@@ -171,7 +542,9 @@ def handle_school(school, defaults, session):
 
 	# Add teachers to meta object
 	box_print("║   ║", "Requesting teacher information…")
-	teachers = session.getTeachers()
+	with profiler.phase("meta:getTeachers"):
+		# Copied, since the session may hand out the same list again
+		teachers = list(session.getTeachers())
 
 	if "teachers" in school:
 		teachers += load_teachers_from_file(school["teachers"])
@@ -181,24 +554,34 @@ def handle_school(school, defaults, session):
 		meta["teachers"][t.id] = t.name
 
 	box_print("║   ║", "Requesting timegrid information…")
-	timegrid = session.getTimegridUnits()
+	with profiler.phase("meta:getTimegridUnits"):
+		timegrid = session.getTimegridUnits()
 	meta["timegrid"] = []
 	for tg in timegrid:
 		meta["timegrid"].insert(tg.day, tg.to_json())
 
-	box_print("║   ║", "Adding last update times…")
-	last_update = session.getLatestImportTime()
-	meta["lastUpdated"] = last_update.strftime("%d.%m.%Y %H:%M:%S")
-	meta["lastUpdatedISO8601"] = last_update.strftime("%Y-%m-%d %H:%M:%S")
-
 	lastGeneratedDate = datetime.now()
-	meta["lastGenerated"] = lastGeneratedDate.strftime("%d.%m.%Y %H:%M:%S")
-	meta["lastGeneratedISO8601"] = lastGeneratedDate.strftime("%Y-%m-%d %H:%M:%S")
 
-	box_print("║   ║", "Writing meta.json…")
-	with open(join(plan_dir, "meta.json"), mode="w", encoding="utf-8") as meta_file:
-		meta_file.write(json.dumps(meta, ensure_ascii = False, sort_keys = True, indent = 2))
-		box_print("║   ║", "Done.")
+	# Targeted runs only update some plans, so meta.json is left as it is
+	if not targeted:
+		box_print("║   ║", "Adding last update times…")
+		with profiler.phase("meta:getLatestImportTime"):
+			last_update = session.getLatestImportTime()
+		meta["lastUpdated"] = last_update.strftime("%d.%m.%Y %H:%M:%S")
+		meta["lastUpdatedISO8601"] = last_update.strftime("%Y-%m-%d %H:%M:%S")
+
+		meta["lastGenerated"] = lastGeneratedDate.strftime("%d.%m.%Y %H:%M:%S")
+		meta["lastGeneratedISO8601"] = lastGeneratedDate.strftime("%Y-%m-%d %H:%M:%S")
+
+		box_print("║   ║", "Writing meta.json…")
+		with profiler.phase("meta:write"):
+			meta_data = json.dumps(meta, ensure_ascii = False, sort_keys = True, indent = 2).encode("utf-8")
+			with open(join(plan_dir, "meta.json"), mode="wb") as meta_file:
+				meta_file.write(meta_data)
+				box_print("║   ║", "Done.")
+
+		if publish:
+			publish("meta.json", meta_data)
 
 	###############
 	# Part where we create timetable files for the web interface
@@ -206,18 +589,48 @@ def handle_school(school, defaults, session):
 
 	box_print("╠═╣", "Timetable JSON files", "center")
 
-	week3_fri = get_other_weekday(weekday_index = 4, week_index = 2) # Get the last school day of the week after next
+	last_fri = get_other_weekday(weekday_index = 4, week_index = weeks - 1) # Get the last school day of the last week
 
 	# Clamp start and end dates. If one of these dates is not within the schoolyear start and end dates, the API will return an error
-	clamped_start_date = max(current_schoolyear.start_date, week1_mon)
-	clamped_end_date = min(current_schoolyear.end_date, week3_fri)
+	clamped_start_date = max(current_schoolyear.start_date, week_mondays[0])
+	clamped_end_date = min(current_schoolyear.end_date, last_fri)
+
+	# A date range only fetches the days it shares with the plans, the rest is kept from the existing files
+	fetch_start_date, fetch_end_date = clamped_start_date, clamped_end_date
+	if date_range:
+		range_start, range_end = date_range
+		fetch_start_date = max(fetch_start_date, range_start or fetch_start_date)
+		fetch_end_date = min(fetch_end_date, range_end or fetch_end_date)
+		if fetch_start_date > fetch_end_date:
+			box_print("║   ║", "Nothing to do for these dates.")
+			session.logout()
+			return
+
+	merge_range = (fetch_start_date, fetch_end_date) if targeted else None
+
+	# Long date ranges are fetched in several smaller requests running in parallel
+	chunks = list(date_chunks(fetch_start_date, fetch_end_date, chunk_weeks))
+	workers = defaults["workers"]
+
+	# Everything fetched from here on is also recorded in the local store, if there is one
+	store_path = school.get("store", defaults["store"])
+	store, store_run = None, None
+	if store_path:
+		from PyUntisStore import PyUntisStore
+		store = PyUntisStore(expanduser(store_path))
+		store_run = store.begin_run(school["name"], fetch_start_date, fetch_end_date)
+
+		if class_ids is not None:
+			# Lessons of all other classes weren't fetched, so they mustn't be marked as removed
+			store_run.mark_incomplete(PyUntisStore.LESSON)
 
 	box_print("║   ║", "Requesting substitution data…")
 	substitutions = None
 	substitutions_denied = False
 	try:
 		# Turns out that some schools restrict access to substitutions for some reason, so this has to be in a try-except block
-		substitutions = session.getSubstitutions(start_date = clamped_start_date.untis_date, end_date = clamped_end_date.untis_date)
+		with profiler.phase("substitutions"):
+			substitutions = fetch_substitutions(session, chunks, workers, profiler, store_run)
 	except PyUntisError as e:
 		box_print("║   ║", str(e))
 		if e.error_id == -8509:
@@ -225,116 +638,238 @@ def handle_school(school, defaults, session):
 	except:
 		box_print("║   ║", "Unknown error fetching substitutions")
 
-	for kl in classes:
-		box_print("║   ║", "Requesting timetables for {0}…".format(kl))
+	if store_run and substitutions is None:
+		store_run.mark_incomplete(PyUntisStore.SUBSTITUTION)
 
-		timetable = session.getTimetableCustom(kl.id, PyUntisElementType.CLASS,
-			start_date = clamped_start_date.untis_date, end_date = clamped_end_date.untis_date,
-			showInfo = True, showSubstText = True, showLsText = True, showLsNumber = True, showStudentgroup = True)
+	if not substitutions:
+		box_print("║   ║", "No substitutions to write!")
 
-		timetable_days = [PyUntisDate(d) for d in daterange(clamped_start_date.date, clamped_end_date.date) if d.weekday() < 5]
+	exams = None
+	if school.get("exams", defaults["exams"]):
+		box_print("║   ║", "Requesting exams…")
+		with profiler.phase("exams"):
+			exams = fetch_exams(session, chunks, workers, profiler)
+		box_print("║   ║", "{0} exams found.".format(len(exams)))
 
-		timetable_json = {}
+	if class_ids is not None:
+		# Only the selected classes' plans are updated, so it's cheapest to fetch just those
+		classes = [kl for kl in classes if kl.id in class_ids]
+	box_print("║   ║", "Fetching lessons ({0} requests)…".format(len(classes) * len(chunks)))
 
-		timetable_json["firstDay"] = {
-			"untis": str(clamped_start_date.untis_date),
-			"iso8601": clamped_start_date.iso8601(),
-			"readable": clamped_start_date.make_readable()
-		}
+	# Targeted runs merge their substitutions into the existing ones, even if there are none in their range
+	has_substitutions = substitutions is not None if targeted else bool(substitutions)
 
-		timetable_json["weeks"] = [[] for x in range(3)]
+	school_calendar = PyUntisSchoolCalendar(clamped_start_date, clamped_end_date, weeks, holidays)
+	manifest = PyUntisManifest(plan_dir, school.get("deltaHistory", defaults["deltaHistory"]))
 
-		# date_idx goes from 0 to 14 (3 weeks)
-		for date_idx in range(len(timetable_days)):
-			date = timetable_days[date_idx]
+	pipeline = PyUntisPipeline([
+		lambda _: fetch_stage(session, classes, chunks, workers, profiler),
+		lambda class_entries: parse_stage(class_entries, classes, profiler, store_run),
+		lambda class_lessons: group_stage(class_lessons, substitutions or [], profiler, derived_plans=class_ids is None, exams=exams, teacher_names=meta["teachers"]),
+		lambda plans: serialize_stage(plans, school_calendar, has_substitutions, substitutions_denied, profiler, merge_range, plan_dir),
+		lambda plan_files: publish_stage(plan_files, plan_dir, manifest, profiler, publish)
+	], maxsize=workers, profiler=profiler)
 
-			week_idx = math.floor(date_idx / 5) # zero-based week index (for 3 weeks: 0-2)
-
-			day_json = {}
-
-			# list of all holidays on the given day. should never be larger than 1
-			possible_holidays = [h for h in holidays if h.start_date <= date and h.end_date >= date]
-			if len(possible_holidays) > 0:
-				# append holiday to week
-				day_json["holiday"] = possible_holidays[0].to_json()
-				timetable_json["weeks"][week_idx].append(day_json)
-				continue # this is a holiday, skip it
-
-			# not actually sure that with the holiday check above, this is still needed
-			day_lessons = sorted([t for t in timetable if t.date == date], key=lambda l: l.start_time)
-			if len(day_lessons) == 0:
-				# append "empty" day to week
-				timetable_json["weeks"][week_idx].append(day_json)
-				continue # skip days without any lessons
+	try:
+		try:
+			with profiler.phase("pipeline"):
+				published_files = pipeline.run()
+		finally:
+			# Plan files that were written have to be in the manifest, even if something failed afterwards
+			box_print("║   ║", "Writing manifest.json…")
+			manifest_data = manifest.save(lastGeneratedDate)
+			if publish:
+				publish(PyUntisManifest.MANIFEST_FILE_NAME, manifest_data)
+
+		if store_run:
+			box_print("║   ║", "Updating local store…")
+			with profiler.phase("store"):
+				store_run.finish()
+	except:
+		if store_run:
+			store_run.abort()
+		raise
+	finally:
+		if store:
+			store.close()
 
-			date_timeunits = timegrid[date.date.weekday()]
+	box_print("║   ║", "{0} plan files published.".format(len(published_files)))
 
-			last_start_time = 0
-			for lesson in day_lessons:
-				lesson_json = lesson.to_json()
+	if not targeted:
+		session.save_master_cache(master_cache_path)
 
-				# note for later: test.sort(function(a, b) { return a.localeCompare(b);})
-				if last_start_time != lesson.start_time.untis_time:
-					# This is a new time slot, create new lesson
-					day_json[lesson.start_time.untis_time] = [lesson_json]
-				else:
-					# This time slot already exists, append lesson
-					day_json[lesson.start_time.untis_time].append(lesson_json)
-
-				last_start_time = lesson.start_time.untis_time
-
-			timetable_json["weeks"][week_idx].append(day_json)
-
-		if substitutions:
-			class_substitutions = [subst for subst in substitutions if kl in subst.classes]
-			timetable_json["substitutions"] = []
-			for subst in class_substitutions:
-				subst_json = subst.to_json()
-				if subst_json:
-					timetable_json["substitutions"].append(subst_json)
-		else:
-			box_print("║   ║", "No substitutions to write!")
-			timetable_json["substitutionDenied"] = substitutions_denied
-
-		timetable_dumped = json.dumps(timetable_json, ensure_ascii=False)
-		plan_file_name = "{0}.json".format(kl.id)
-		with open(join(plan_dir, plan_file_name), mode="w", encoding="utf-8") as plan_file:
-			plan_file.write(timetable_dumped)
-			box_print("║   ║", "{0} written.".format(plan_file_name), "right")
+	if session.memo_hits:
+		box_print("║   ║", "{0} duplicate requests avoided.".format(session.memo_hits))
 
 	box_print("╠╦═╦╣")
 	box_print("║║ ║║", "Logging out…", "center")
 	box_print("╠╩═╩╣")
 
-	session.logout()
+	with profiler.phase("logout"):
+		session.logout()
+
+# The URL prefix a school's files are served under in serve mode
+def school_slug(school):
+	return school.get("slug") or re.sub(r"[^a-z0-9]+", "-", school["name"].lower()).strip("-")
+
+def active_schools(config):
+	return [school for school in config["schools"] if not school["name"].startswith("#")]
+
+# Whether a school was selected on the command line by its name, display name or slug
+def school_matches(school, names):
+	return any(name.lower() in (school["name"].lower(), school.get("displayName", "").lower(), school_slug(school)) for name in names)
+
+# Parses dates given on the command line, either as YYYY-MM-DD or YYYYMMDD
+def parse_date_arg(value):
+	for date_format in [PyUntisDate.ISO8601_FMT, PyUntisDate.UNTIS_DATE_FMT]:
+		try:
+			return PyUntisDate(date=datetime.strptime(value, date_format))
+		except ValueError:
+			pass
+
+	raise argparse.ArgumentTypeError("invalid date: {0}".format(value))
+
+# Writes a school's phase timings to run_report.json next to meta.json,
+# along with profile.pstats if cProfile was used
+def write_profile(school, profiler):
+	plan_dir = expanduser(school["planDir"])
+
+	profiler.write_report(join(plan_dir, "run_report.json"), datetime.now())
+	if profiler.dump_stats(join(plan_dir, "profile.pstats")):
+		box_print("║   ║", "profile.pstats written.")
+
+	box_print("║   ║", "Slowest phases:")
+	for name, phase in profiler.slowest_phases(10):
+		box_print("║   ║", "{0:.3f}s {1} (×{2})".format(phase["total"], name, phase["count"]))
+
+def run_schools(config, defaults, session, cache=None, profile=False, use_cprofile=False, school_names=None, class_ids=None, date_range=None):
+	for school in config["schools"]:
+		school_name = school["name"]
+		if school_name.startswith("#"):
+			box_print("║   ║", f"Skipping {school_name[1:]}.")
+			continue
+
+		if school_names and not school_matches(school, school_names):
+			continue
+
+		publish = None
+		if cache:
+			def publish(file_name, data, slug=school_slug(school)):
+				cache.publish("/".join([slug, file_name.replace(os.sep, "/")]), data)
+
+				# Plans and deltas the new manifest doesn't list anymore mustn't be served any longer
+				if file_name == PyUntisManifest.MANIFEST_FILE_NAME:
+					cache.retain(slug, ["meta.json"] + [f.replace(os.sep, "/") for f in PyUntisManifest.listed_files(data)])
+
+		profiler = PyUntisProfiler(enabled=profile, use_cprofile=use_cprofile)
+		with profiler.profile_thread():
+			handle_school(school, defaults, session = session, publish = publish, profiler = profiler, class_ids = class_ids, date_range = date_range)
+
+		if profile:
+			write_profile(school, profiler)
+
+	box_print("║   ║", "{requests} requests over {connections} connections ({reused} reused).".format(**session.transport_stats()))
+
+# Serve mode: regenerates all schools every `interval` seconds and serves the generated files
+# from memory until the process is stopped. Files generated by previous runs are served until
+# the first regeneration is done.
+def serve(config, defaults, host, port, interval, profile=False, use_cprofile=False):
+	import asyncio
+	from PyUntisServer import PyUntisResponseCache, PyUntisServer
+	from PyUntisSession import PyUntisSession
+
+	cache = PyUntisResponseCache()
+	for school in active_schools(config):
+		cache.load_dir(school_slug(school), expanduser(school["planDir"]))
+		box_print("║   ║", "Serving {0} at /{1}/".format(school["name"], school_slug(school)))
+
+	async def regenerate():
+		loop = asyncio.get_running_loop()
+		while True:
+			tick = datetime.now()
+			try:
+				await loop.run_in_executor(None, run_schools, config, defaults, PyUntisSession(defaults["transport"], defaults["memoTTL"]), cache, profile, use_cprofile)
+			except Exception as e:
+				box_print("║   ║", "Regeneration failed: {0}".format(e))
+
+			box_print("║   ║", "Regenerated in {0}".format(datetime.now() - tick))
+			await asyncio.sleep(interval)
+
+	box_print("║   ║", "Listening on {0}:{1}…".format(host, port))
+	server = PyUntisServer(cache, host, port)
+	asyncio.run(server.run(regenerate()))
 
 def main():
-	tick = datetime.now()
+	parser = argparse.ArgumentParser(description="Generates timetable JSON files from WebUntis.")
+	subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+	generate_parser = subparsers.add_parser("generate", help="generate plan files once (default)")
+	generate_parser.add_argument("--school", dest="schools", action="append", metavar="NAME", help="only generate this school, by name, display name or slug (repeatable)")
+	generate_parser.add_argument("--class", dest="class_ids", action="append", type=int, metavar="ID", help="only update the plan of this class ID (repeatable)")
+	generate_parser.add_argument("--from", dest="from_date", type=parse_date_arg, metavar="DATE", help="only update days from this date on (YYYY-MM-DD)")
+	generate_parser.add_argument("--to", dest="to_date", type=parse_date_arg, metavar="DATE", help="only update days up to this date (YYYY-MM-DD)")
+
+	serve_parser = subparsers.add_parser("serve", help="keep running, regenerate periodically and serve the generated files over HTTP")
+	serve_parser.add_argument("--host", help="address to serve on (default: 127.0.0.1)")
+	serve_parser.add_argument("--port", type=int, help="port to serve on (default: 8080)")
+	serve_parser.add_argument("--interval", type=int, help="seconds between regenerations (default: 300)")
+
+	for subparser in [generate_parser, serve_parser]:
+		subparser.add_argument("--profile", action="store_true", help="time each phase and write run_report.json next to each school's meta.json")
+		subparser.add_argument("--cprofile", action="store_true", help="with --profile, also run under cProfile and write profile.pstats")
 
-	s = PyUntisSession()
+	# Running without a command generates everything, just like before there were commands
+	argv = sys.argv[1:]
+	if not argv or argv[0] not in ["generate", "serve", "-h", "--help"]:
+		argv = ["generate"] + argv
+	args = parser.parse_args(argv)
+
+	# Only imported now, so that --help and invalid arguments don't have to wait for requests
+	from PyUntisSession import PyUntisSession
+
+	tick = datetime.now()
 
 	box_print("╔╦═╦╗")
-	box_print("║║ ║║", "{0} - {1}".format(s.USER_AGENT, tick.strftime("%d.%m.%Y %H:%M:%S")), "center")
+	box_print("║║ ║║", "{0} - {1}".format(PyUntisSession.USER_AGENT, tick.strftime("%d.%m.%Y %H:%M:%S")), "center")
 	box_print("╠╩═╩╣")
 
 	box_print("║   ║", "Loading config…")
-	box_print("║   ║", "Loaded.")
-
 	config_json = open("config.json", "r", encoding="utf8")
 	config = json.load(config_json)
 	config_json.close()
+	box_print("║   ║", "Loaded.")
 
 	defaults = {
-		"locale": locale.getdefaultlocale()
+		"locale": locale.getdefaultlocale(),
+		"weeks": 3,
+		"chunkWeeks": 4,
+		"workers": config.get("workers", 4),
+		"deltaHistory": 10,
+		"store": config.get("store"),
+		"exams": config.get("exams", False),
+		"memoTTL": config.get("memoTTL")
 	}
 
-	for school in config["schools"]:
-		school_name = school["name"]
-		if school_name.startswith("#"):
-			box_print("║   ║", f"Skipping {school_name[1:]}.")
-			continue
+	# By default, there's one pooled connection for each worker
+	defaults["transport"] = {"poolSize": defaults["workers"], **config.get("transport", {})}
+
+	if args.command == "serve":
+		# Options given on the command line take precedence over the ones in config.json
+		serve_config = config.get("serve", {})
+		host = args.host or serve_config.get("host", "127.0.0.1")
+		port = args.port or serve_config.get("port", 8080)
+		interval = args.interval or serve_config.get("interval", 300)
+
+		serve(config, defaults, host, port, interval, args.profile, args.cprofile)
+		return
+
+	date_range = None
+	if args.from_date or args.to_date:
+		# A missing end is left open, i.e. it's the start or end of each school's plan window
+		date_range = (args.from_date, args.to_date)
 
-		handle_school(school, defaults, session = s)
+	run_schools(config, defaults, PyUntisSession(defaults["transport"], defaults["memoTTL"]), profile=args.profile, use_cprofile=args.cprofile,
+		school_names=args.schools, class_ids=args.class_ids, date_range=date_range)
 
 	tock = datetime.now()
 	diff = tock - tick
@@ -344,4 +879,4 @@ def main():
 	box_print("╚╩═╩╝")
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3.6
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections.abc import Sequence
    
 class PyUntisError(Exception):
@@ -285,6 +285,52 @@ class PyUntisDayGrid(Sequence):
 	def to_json(self):
 		return [tu.to_json() for tu in self.time_units]
 		
+class PyUntisCalendarDay:
+	def __init__(self, date, week_index, day_index, holiday=None):
+		self.date = date
+		self.week_index = week_index
+		self.day_index = day_index
+		self.holiday = holiday
+		
+	def __repr__(self):
+		return "{0} (week {1}, day {2}){3}".format(self.date.make_readable(), self.week_index, self.day_index, " - {0}".format(self.holiday) if self.holiday else "")
+		
+# Everything about a school's plan window that doesn't depend on the class, teacher or room:
+# which days are school days, where they go in the plan's weeks and which ones are holidays.
+# This only needs to be built once per school.
+class PyUntisSchoolCalendar:
+	def __init__(self, start_date, end_date, weeks, holidays):
+		self.start_date = start_date
+		self.end_date = end_date
+		self.weeks = weeks
+		
+		self.first_day_json = {
+			"untis": str(start_date.untis_date),
+			"iso8601": start_date.iso8601(),
+			"readable": start_date.make_readable()
+		}
+		
+		self.days = []
+		day = start_date.date
+		while day <= end_date.date:
+			if day.weekday() < 5:
+				date = PyUntisDate(date=day)
+				date_idx = len(self.days)
+				
+				# list of all holidays on the given day. should never be larger than 1
+				possible_holidays = [h for h in holidays if h.start_date <= date and h.end_date >= date]
+				holiday = possible_holidays[0] if possible_holidays else None
+				
+				self.days.append(PyUntisCalendarDay(date, date_idx // 5, date_idx % 5, holiday = holiday))
+				
+			day += timedelta(days = 1)
+			
+		# Holiday JSON is the same in every plan, so it's only generated once
+		self.holiday_json = {d.date.untis_date: d.holiday.to_json() for d in self.days if d.holiday}
+		
+	def __repr__(self):
+		return "Calendar {0} - {1}: {2} days in {3} weeks".format(self.start_date.make_readable(), self.end_date.make_readable(), len(self.days), self.weeks)
+		
 class PyUntisStatusData:
 	def __init__(self, status_json):
 		self.codes = status_json["codes"]
@@ -316,6 +362,7 @@ class PyUntisTimetableEntry:
 		self.classes = [PyUntisClass(kl) for kl in tt_entry_json["kl"]]
 		self.subjects = [PyUntisSubject(su) for su in tt_entry_json["su"]]
 		self.rooms = [PyUntisRoom(ro) for ro in tt_entry_json["ro"]]
+		self.teachers = [PyUntisTeacher(te) for te in tt_entry_json.get("te", [])] # missing if the account can't see teachers
 		self.date = PyUntisDate(untis_date=tt_entry_json["date"])
 		self.start_time = PyUntisTime(untis_time=tt_entry_json["startTime"])
 		self.end_time = PyUntisTime(untis_time=tt_entry_json["endTime"])
@@ -428,3 +475,52 @@ class PyUntisSubstitution:
 			self.subjects, self.start_time.make_readable(), self.end_time.make_readable(),
 			self.reschedule or None
 		)
+
+class PyUntisExamType:
+	def __init__(self, exam_type_json):
+		self.id = exam_type_json["id"]
+		self.name = exam_type_json.get("name")
+		self.long_name = exam_type_json.get("longName")
+		self.show_in_timetable = exam_type_json.get("showInTimetable")
+		
+	def __repr__(self):
+		return self.long_name or self.name or str(self.id)
+		
+# {'id', 'classes', 'teachers', 'students', 'subject', 'date', 'startTime', 'endTime'}
+# Unlike lessons and substitutions, exams only contain the IDs of their classes, teachers and subject
+class PyUntisExam:
+	def __init__(self, exam_json, exam_type=None):
+		self.id = exam_json["id"]
+		self.exam_type = exam_type
+		self.class_ids = exam_json.get("classes", [])
+		self.teacher_ids = exam_json.get("teachers", [])
+		self.student_ids = exam_json.get("students", [])
+		self.subject_id = exam_json.get("subject")
+		self.date = PyUntisDate(untis_date=exam_json["date"])
+		self.start_time = PyUntisTime(untis_time=exam_json["startTime"])
+		self.end_time = PyUntisTime(untis_time=exam_json["endTime"])
+		
+	# subject_names and teacher_names map IDs to names, IDs without a name are left out
+	def to_json(self, subject_names, teacher_names):
+		exam_json = {}
+		if self.exam_type:
+			exam_json["type"] = self.exam_type.name
+			exam_json["typeLongName"] = self.exam_type.long_name
+			
+		exam_json["date"] = self.date.untis_date
+		exam_json["readableDate"] = self.date.make_readable()
+		exam_json["time"] = self.start_time.untis_time
+		exam_json["readableTime"] = self.start_time.make_readable()
+		exam_json["endTime"] = self.end_time.untis_time
+		exam_json["readableEndTime"] = self.end_time.make_readable()
+		
+		exam_json["subject"] = subject_names.get(self.subject_id, "")
+		exam_json["teachers"] = [teacher_names[te] for te in self.teacher_ids if te in teacher_names]
+		
+		return exam_json
+		
+	def __repr__(self):
+		return "{0} for class(es) {1} on {2}, {3} - {4}".format(
+			self.exam_type or "Exam", self.class_ids, self.date.make_readable(),
+			self.start_time.make_readable(), self.end_time.make_readable()
+		)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+from os.path import join, exists
+from collections import Counter
+
+# Computes a delta that turns the plan old_json into new_json.
+# A delta contains:
+#  "days": changed days, each with the time slots that changed. A slot set to null was removed.
+#          Holidays are treated like any other slot.
+#  "substitutionsAdded"/"substitutionsRemoved": substitutions that were added or removed.
+#  "set": other top-level values that changed. A value set to null was removed.
+# Returns None if the plans can't be patched into each other (e.g. after the plan window moved on),
+# in which case clients have to fetch the full plan file.
+def make_plan_delta(old_json, new_json):
+	if old_json.get("firstDay") != new_json.get("firstDay"):
+		return None
+
+	old_weeks, new_weeks = old_json.get("weeks", []), new_json.get("weeks", [])
+	if [len(w) for w in old_weeks] != [len(w) for w in new_weeks]:
+		return None
+
+	if ("substitutions" in old_json) != ("substitutions" in new_json):
+		return None
+
+	delta = {}
+
+	delta["days"] = []
+	for week_idx, (old_week, new_week) in enumerate(zip(old_weeks, new_weeks)):
+		for day_idx, (old_day, new_day) in enumerate(zip(old_week, new_week)):
+			if old_day == new_day:
+				continue
+
+			slots = {slot: new_day.get(slot) for slot in old_day.keys() | new_day.keys() if old_day.get(slot) != new_day.get(slot)}
+			delta["days"].append({"week": week_idx, "day": day_idx, "slots": slots})
+
+	# Substitutions don't have IDs, so they're compared by their contents
+	old_substs = Counter(json.dumps(subst, sort_keys=True) for subst in old_json.get("substitutions", []))
+	new_substs = Counter(json.dumps(subst, sort_keys=True) for subst in new_json.get("substitutions", []))
+	delta["substitutionsAdded"] = [json.loads(subst) for subst in (new_substs - old_substs).elements()]
+	delta["substitutionsRemoved"] = [json.loads(subst) for subst in (old_substs - new_substs).elements()]
+
+	ignored_keys = {"firstDay", "weeks", "substitutions", "version"}
+	delta["set"] = {k: new_json.get(k) for k in (old_json.keys() | new_json.keys()) - ignored_keys if old_json.get(k) != new_json.get(k)}
+
+	return delta
+
+# Keeps track of the version of every plan file of a school and the deltas between versions.
+# A plan's delta from version N-1 to N is stored in delta/{plan}/{N}.json.
+# Clients on version v can catch up using deltas v+1 to the current version
+# as long as v is at least the plan's "since" version, otherwise they have to refetch the full plan.
+# Every plan file contains its own version, since it can be newer than the manifest a client got.
+# Changes are detected by the hash of each plan's contents stored in the manifest rather than by the file on disk,
+# so a plan written by a run that failed before saving the manifest still gets a new version.
+class PyUntisManifest:
+	MANIFEST_FILE_NAME = "manifest.json"
+	DELTA_DIR_NAME = "delta"
+
+	def __init__(self, plan_dir, delta_history=10):
+		self.plan_dir = plan_dir
+		self.delta_history = delta_history
+		self.manifest_path = join(plan_dir, self.MANIFEST_FILE_NAME)
+
+		self.files = {}
+		if exists(self.manifest_path):
+			with open(self.manifest_path, "r", encoding="utf-8") as manifest_file:
+				self.files = json.load(manifest_file).get("files", {})
+
+	@classmethod
+	def delta_path(cls, plan_file_name, version):
+		return join(cls.DELTA_DIR_NAME, os.path.splitext(plan_file_name)[0], "{0}.json".format(version))
+
+	# Records a plan's contents (without its version) and returns the plan's version, along with a list of
+	# (file name, bytes) tuples of deltas that have to be written with the plan file.
+	# old_data is the currently published plan file, or None if there is none.
+	def update(self, plan_file_name, plan_data, new_json, old_data):
+		content_hash = hashlib.sha1(plan_data).hexdigest()
+		entry = self.files.get(plan_file_name)
+		if entry is not None and entry.get("hash") == content_hash:
+			return entry["version"], []
+
+		old_json = json.loads(old_data) if old_data else {}
+		if entry is not None and "hash" not in entry:
+			# This plan was published before plan files contained their version
+			if old_data == plan_data:
+				entry["hash"] = content_hash
+				return entry["version"], []
+
+			old_json.setdefault("version", entry["version"])
+
+		published_version = old_json.get("version")
+		if entry is None:
+			# Either this is a new plan file or we have no idea what clients have seen so far
+			version = (published_version or 0) + 1
+			self.files[plan_file_name] = {"version": version, "since": version, "hash": content_hash}
+			return version, []
+
+		# The published file can be newer than the manifest if a run failed before saving it.
+		# Deltas only work from the version the manifest knows about, so clients have to refetch then.
+		version = max(entry["version"], published_version or 0) + 1
+		delta = None
+		if published_version == entry["version"] and self.delta_history > 0:
+			delta = make_plan_delta(old_json, new_json)
+
+		entry["version"] = version
+		entry["since"] = version if delta is None else max(entry["since"], version - self.delta_history)
+		entry["hash"] = content_hash
+		self._prune(plan_file_name, entry["since"])
+
+		if delta is None:
+			return version, []
+
+		delta["from"] = version - 1
+		delta["to"] = version
+
+		return version, [(self.delta_path(plan_file_name, version), json.dumps(delta, ensure_ascii=False).encode("utf-8"))]
+
+	# Removes deltas that clients can't use anymore
+	def _prune(self, plan_file_name, since):
+		delta_dir = join(self.plan_dir, os.path.dirname(self.delta_path(plan_file_name, since)))
+		if not exists(delta_dir):
+			return
+
+		for delta_file_name in os.listdir(delta_dir):
+			version = os.path.splitext(delta_file_name)[0]
+			if version.isdigit() and int(version) <= since:
+				os.remove(join(delta_dir, delta_file_name))
+
+	# Returns the names of all files a manifest (as returned by save()) refers to, including the manifest itself
+	@classmethod
+	def listed_files(cls, manifest_data):
+		file_names = [cls.MANIFEST_FILE_NAME]
+		for plan_file_name, entry in json.loads(manifest_data)["files"].items():
+			file_names.append(plan_file_name)
+			file_names += [cls.delta_path(plan_file_name, version) for version in range(entry["since"] + 1, entry["version"] + 1)]
+
+		return file_names
+
+	# Writes the manifest and returns its contents
+	def save(self, generated):
+		manifest = {
+			"generated": generated.strftime("%Y-%m-%d %H:%M:%S"),
+			"files": self.files
+		}
+		manifest_data = json.dumps(manifest, ensure_ascii=False, sort_keys=True, indent=2).encode("utf-8")
+
+		manifest_tmp_path = self.manifest_path + ".tmp"
+		with open(manifest_tmp_path, mode="wb") as manifest_file:
+			manifest_file.write(manifest_data)
+
+		os.replace(manifest_tmp_path, self.manifest_path)
+
+		return manifest_data
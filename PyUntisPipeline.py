@@ -0,0 +1,96 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import contextlib
+
+# Marks the end of a stage's output
+_DONE = object()
+
+class _PyUntisPipelineAborted(Exception):
+	pass
+
+# Runs a list of stages in their own threads, connected by bounded queues.
+# Every stage is a function that takes an iterator of the previous stage's items
+# and yields its own items, so a stage can either map items one by one or collect
+# several of them before yielding anything. The first stage gets an empty iterator.
+# Because the queues are bounded, a fast stage can't run away from a slow one,
+# so only a handful of items are ever held between two stages at the same time.
+# If a stage raises an exception, all other stages are stopped and run() re-raises it.
+# If a PyUntisProfiler is given, every stage's thread is profiled with it.
+class PyUntisPipeline:
+	POLL_INTERVAL = 0.1
+
+	def __init__(self, stages, maxsize=4, profiler=None):
+		self.stages = stages
+		self.maxsize = maxsize
+		self.profiler = profiler
+
+		self._abort = threading.Event()
+		self._errors = []
+
+	def _put(self, q, item):
+		while not self._abort.is_set():
+			try:
+				q.put(item, timeout=self.POLL_INTERVAL)
+				return
+			except queue.Full:
+				continue
+
+		raise _PyUntisPipelineAborted()
+
+	def _iter_queue(self, q):
+		while not self._abort.is_set():
+			try:
+				item = q.get(timeout=self.POLL_INTERVAL)
+			except queue.Empty:
+				continue
+
+			if item is _DONE:
+				return
+
+			yield item
+
+		raise _PyUntisPipelineAborted()
+
+	def _run_stage(self, stage, inbox, outbox):
+		try:
+			with self.profiler.profile_thread() if self.profiler else contextlib.nullcontext():
+				items = self._iter_queue(inbox) if inbox is not None else iter(())
+				for item in stage(items):
+					self._put(outbox, item)
+
+			self._put(outbox, _DONE)
+		except _PyUntisPipelineAborted:
+			pass
+		except BaseException as e:
+			self._errors.append(e)
+			self._abort.set()
+
+	# Runs all stages and returns the last stage's items
+	def run(self):
+		queues = [queue.Queue(maxsize=self.maxsize) for stage in self.stages]
+		threads = []
+		for i, stage in enumerate(self.stages):
+			inbox = queues[i - 1] if i > 0 else None
+			t = threading.Thread(target=self._run_stage, args=(stage, inbox, queues[i]), name="PyUntisPipeline-{0}".format(i), daemon=True)
+			threads.append(t)
+			t.start()
+
+		results = []
+		try:
+			results = list(self._iter_queue(queues[-1]))
+		except _PyUntisPipelineAborted:
+			pass
+		finally:
+			# Every stage has finished by the time the last one is done, so this only stops stages that are still running
+			self._abort.set()
+
+			for t in threads:
+				t.join()
+
+		if self._errors:
+			raise self._errors[0]
+
+		return results
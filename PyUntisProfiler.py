@@ -0,0 +1,107 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# Collects how long each phase of a school's generation took.
+# Phases can be entered from any thread and as often as needed, e.g. once per class,
+# and are summed up by name. A disabled profiler doesn't measure anything,
+# so phases can be marked unconditionally.
+# With use_cprofile, each thread that calls profile_thread() (or runs a profiled() function) is additionally run under cProfile
+# and all of their stats can be dumped into a single .pstats file.
+class PyUntisProfiler:
+	def __init__(self, enabled=False, use_cprofile=False):
+		self.enabled = enabled
+		self.use_cprofile = enabled and use_cprofile
+
+		self.phases = {}
+		self.profiles = []
+		self.lock = threading.Lock()
+		self.started = time.perf_counter()
+
+	@contextmanager
+	def phase(self, name):
+		if not self.enabled:
+			yield
+			return
+
+		tick = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - tick)
+
+	def add(self, name, duration):
+		with self.lock:
+			phase = self.phases.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+			phase["count"] += 1
+			phase["total"] += duration
+			phase["max"] = max(phase["max"], duration)
+
+	@contextmanager
+	def profile_thread(self):
+		if not self.use_cprofile:
+			yield
+			return
+
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:
+			# Newer Pythons only allow a single active profiler, so this thread has to go without
+			yield
+			return
+
+		try:
+			yield
+		finally:
+			profile.disable()
+			with self.lock:
+				self.profiles.append(profile)
+
+	# Wraps a function so every call is profiled in the thread it runs in, e.g. on an executor's worker threads
+	def profiled(self, func):
+		def run(*args, **kwargs):
+			with self.profile_thread():
+				return func(*args, **kwargs)
+
+		return run
+
+	def dump_stats(self, path):
+		with self.lock:
+			if not self.profiles:
+				return False
+
+			stats = pstats.Stats(self.profiles[0])
+			for profile in self.profiles[1:]:
+				stats.add(profile)
+
+		stats.dump_stats(path)
+		return True
+
+	# Phases sorted by their total duration, slowest first
+	def slowest_phases(self, limit=None):
+		with self.lock:
+			phases = sorted(self.phases.items(), key=lambda p: p[1]["total"], reverse=True)
+
+		return phases[:limit] if limit else phases
+
+	def report(self, generated):
+		return {
+			"generated": generated.strftime("%Y-%m-%d %H:%M:%S"),
+			"total": round(time.perf_counter() - self.started, 4),
+			"phases": {name: {
+				"count": phase["count"],
+				"total": round(phase["total"], 4),
+				"max": round(phase["max"], 4)
+			} for name, phase in self.slowest_phases()}
+		}
+
+	def write_report(self, path, generated):
+		with open(path, mode="w", encoding="utf-8") as report_file:
+			report_file.write(json.dumps(self.report(generated), ensure_ascii=False, indent=2))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import gzip
+import asyncio
+import hashlib
+import threading
+from os.path import join
+from urllib.parse import urlsplit, parse_qs, unquote
+from email.utils import formatdate
+
+# A single pre-serialized file, along with its precompressed version and ETag
+class PyUntisResponse:
+	def __init__(self, data, etag=None):
+		self.data = data
+		self.gzip_data = gzip.compress(data)
+		self.etag = etag or self.make_etag(data)
+
+	@staticmethod
+	def make_etag(data):
+		return "\"{0}\"".format(hashlib.sha1(data).hexdigest()[:20])
+
+	# Whether an If-None-Match header matches this response.
+	# Handles "*", lists of ETags and weak ETags, which proxies like to turn strong ones into.
+	def matches(self, if_none_match):
+		if if_none_match is None:
+			return False
+
+		if if_none_match.strip() == "*":
+			return True
+
+		for etag in if_none_match.split(","):
+			etag = etag.strip()
+			if etag.startswith("W/"):
+				etag = etag[2:]
+
+			if etag == self.etag:
+				return True
+
+		return False
+
+# Holds the latest version of every generated file in memory.
+# Files are published from the generator's threads and served from the server's event loop,
+# so clients waiting for a file to change are woken up through the loop.
+class PyUntisResponseCache:
+	def __init__(self):
+		self.responses = {}
+		self.lock = threading.Lock()
+
+		self.loop = None
+		self._waiters = {}
+
+	def get(self, path):
+		with self.lock:
+			return self.responses.get(path)
+
+	def publish(self, path, data):
+		# Most files don't change between runs, so they're only compressed again if they did
+		etag = PyUntisResponse.make_etag(data)
+		with self.lock:
+			old_response = self.responses.get(path)
+			if old_response and old_response.etag == etag:
+				return # nothing changed, no need to wake anyone up
+
+		response = PyUntisResponse(data, etag)
+		with self.lock:
+			self.responses[path] = response
+
+		if self.loop:
+			self.loop.call_soon_threadsafe(self._notify, path)
+
+	# Drops all files under a prefix that aren't in file_names (relative to the prefix),
+	# e.g. plans and deltas that a school's new manifest doesn't list anymore.
+	def retain(self, prefix, file_names):
+		kept_paths = set("/".join([prefix, file_name]) for file_name in file_names)
+		with self.lock:
+			evicted_paths = [path for path in self.responses if path.startswith(prefix + "/") and path not in kept_paths]
+			for path in evicted_paths:
+				del self.responses[path]
+
+		# Anyone still waiting for these files gets a 404 right away
+		if self.loop:
+			for path in evicted_paths:
+				self.loop.call_soon_threadsafe(self._notify, path)
+
+	# Loads all JSON files in a directory, e.g. to serve the previous run's files until the next run is done
+	def load_dir(self, prefix, directory):
+		for dir_path, dir_names, file_names in os.walk(directory):
+			dir_names[:] = [d for d in dir_names if not d.startswith(".")] # e.g. the master data cache
+			for file_name in file_names:
+				if not file_name.endswith(".json"):
+					continue
+
+				file_path = join(dir_path, file_name)
+				with open(file_path, "rb") as f:
+					self.publish("/".join([prefix, os.path.relpath(file_path, directory).replace(os.sep, "/")]), f.read())
+
+	def _notify(self, path):
+		event = self._waiters.pop(path, None)
+		if event:
+			event.set()
+
+	# Waits until the given path is published again or the timeout runs out.
+	# Must be called from the event loop.
+	async def wait_for_change(self, path, timeout):
+		event = self._waiters.setdefault(path, asyncio.Event())
+		try:
+			await asyncio.wait_for(event.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+# Small HTTP/1.1 server that only serves files from a PyUntisResponseCache.
+# Supports keep-alive, gzip, ETag/If-None-Match and long polling:
+# adding ?wait=<seconds> to a conditional request keeps it open until the file changes
+# (or the time is up), instead of answering 304 Not Modified right away.
+class PyUntisServer:
+	MAX_WAIT = 60
+	REQUEST_TIMEOUT = 75
+	STATUS_MESSAGES = {
+		200: "OK",
+		304: "Not Modified",
+		400: "Bad Request",
+		404: "Not Found",
+		405: "Method Not Allowed"
+	}
+
+	def __init__(self, cache, host="127.0.0.1", port=8080):
+		self.cache = cache
+		self.host = host
+		self.port = port
+
+	async def run(self, *background_tasks):
+		self.cache.loop = asyncio.get_running_loop()
+
+		server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+		async with server:
+			await asyncio.gather(server.serve_forever(), *background_tasks)
+
+	async def _read_request(self, reader):
+		request_line = await asyncio.wait_for(reader.readline(), self.REQUEST_TIMEOUT)
+		if not request_line:
+			return None
+
+		headers = {}
+		while True:
+			line = await asyncio.wait_for(reader.readline(), self.REQUEST_TIMEOUT)
+			if line in (b"\r\n", b"\n", b""):
+				break
+
+			name, _, value = line.decode("latin-1").partition(":")
+			headers[name.strip().lower()] = value.strip()
+
+		# We don't care about request bodies, but they have to be read to get to the next request
+		if "content-length" in headers:
+			await reader.readexactly(int(headers["content-length"]))
+
+		return request_line.decode("latin-1").split(), headers
+
+	async def _handle_connection(self, reader, writer):
+		try:
+			while True:
+				request = await self._read_request(reader)
+				if request is None:
+					break
+
+				request_line, headers = request
+				keep_alive = await self._handle_request(request_line, headers, writer)
+				await writer.drain()
+
+				if not keep_alive:
+					break
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+			pass
+		finally:
+			writer.close()
+
+	async def _handle_request(self, request_line, headers, writer):
+		if len(request_line) != 3:
+			self._write_response(writer, 400, keep_alive=False)
+			return False
+
+		method, target, version = request_line
+		keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+		if method not in ("GET", "HEAD"):
+			self._write_response(writer, 405, keep_alive=keep_alive, extra_headers={"Allow": "GET, HEAD"})
+			return keep_alive
+
+		url = urlsplit(target)
+		path = unquote(url.path).strip("/")
+		query = parse_qs(url.query)
+
+		response = self.cache.get(path)
+		if response is None:
+			self._write_response(writer, 404, keep_alive=keep_alive)
+			return keep_alive
+
+		if_none_match = headers.get("if-none-match")
+		if response.matches(if_none_match) and "wait" in query:
+			# Long poll: hold on to the request until there's something new
+			try:
+				wait = float(query["wait"][0])
+			except ValueError:
+				wait = math.nan
+
+			if not math.isfinite(wait):
+				self._write_response(writer, 400, keep_alive=keep_alive)
+				return keep_alive
+
+			await self.cache.wait_for_change(path, min(max(wait, 0), self.MAX_WAIT))
+			response = self.cache.get(path)
+			if response is None:
+				self._write_response(writer, 404, keep_alive=keep_alive)
+				return keep_alive
+
+		if response.matches(if_none_match):
+			self._write_response(writer, 304, keep_alive=keep_alive, extra_headers={"ETag": response.etag})
+			return keep_alive
+
+		use_gzip = "gzip" in headers.get("accept-encoding", "")
+		body = response.gzip_data if use_gzip else response.data
+		extra_headers = {
+			"ETag": response.etag,
+			"Content-Type": "application/json; charset=utf-8",
+			"Vary": "Accept-Encoding"
+		}
+		if use_gzip:
+			extra_headers["Content-Encoding"] = "gzip"
+
+		self._write_response(writer, 200, body, keep_alive=keep_alive, extra_headers=extra_headers, head_only=(method == "HEAD"))
+		return keep_alive
+
+	def _write_response(self, writer, status, body=b"", keep_alive=True, extra_headers=None, head_only=False):
+		headers = {
+			"Date": formatdate(usegmt=True),
+			"Cache-Control": "no-cache",
+			"Access-Control-Allow-Origin": "*",
+			"Access-Control-Expose-Headers": "ETag",
+			"Connection": "keep-alive" if keep_alive else "close",
+			**(extra_headers or {})
+		}
+		if status != 304:
+			headers["Content-Length"] = str(len(body))
+
+		head = "HTTP/1.1 {0} {1}\r\n".format(status, self.STATUS_MESSAGES[status])
+		head += "".join("{0}: {1}\r\n".format(k, v) for k, v in headers.items())
+		writer.write((head + "\r\n").encode("latin-1"))
+
+		if status != 304 and not head_only:
+			writer.write(body)
@@ -1,17 +1,85 @@
 #!/usr/bin/env python3.6
 # -*- coding: utf-8 -*-
 
-import json # debug
+import os
+import json
+import time
+import threading
 
 from urllib.parse import urlencode
 from datetime import datetime
+from functools import partial
+from concurrent.futures import Future
 from PyUntisClasses import *
 try:
 	import requests
+	from requests.adapters import HTTPAdapter
+	from urllib3.connectionpool import HTTPSConnectionPool
+	from urllib3.connection import HTTPSConnection
 except ImportError:
 	print("PyUntis requires Requests. You'll need it if you want to use PyUntis.")
 	raise
 
+# HTTPS connection that reports every socket it actually opens (including reconnects of pooled connections)
+# and every request it sends (including retries), to tell how often connections were reused.
+class PyUntisConnection(HTTPSConnection):
+	on_connect = None
+	on_request = None
+	
+	def connect(self):
+		if self.on_connect:
+			self.on_connect()
+		return super().connect()
+		
+	def request(self, *args, **kwargs):
+		if self.on_request:
+			self.on_request()
+		return super().request(*args, **kwargs)
+		
+# Connection pool whose connections report to the given callbacks
+class PyUntisConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = PyUntisConnection
+	
+	def __init__(self, *args, on_connect=None, on_request=None, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.on_connect = on_connect
+		self.on_request = on_request
+		
+	def _new_conn(self):
+		conn = super()._new_conn()
+		conn.on_connect = self.on_connect
+		conn.on_request = self.on_request
+		return conn
+		
+# Keeps up to pool_size connections per host alive, applies default timeouts
+# and counts the requests and socket connects of its connections.
+class PyUntisTransportAdapter(HTTPAdapter):
+	def __init__(self, pool_size, timeout):
+		self.timeout = timeout
+		self.request_count = 0
+		self.connection_count = 0
+		self.stats_lock = threading.Lock()
+		
+		super().__init__(pool_connections=2, pool_maxsize=pool_size)
+		
+	def init_poolmanager(self, *args, **kwargs):
+		super().init_poolmanager(*args, **kwargs)
+		self.poolmanager.pool_classes_by_scheme = {
+			**self.poolmanager.pool_classes_by_scheme,
+			"https": partial(PyUntisConnectionPool, on_connect=self._count_connection, on_request=self._count_request)
+		}
+		
+	def _count_connection(self):
+		with self.stats_lock:
+			self.connection_count += 1
+			
+	def _count_request(self):
+		with self.stats_lock:
+			self.request_count += 1
+			
+	def send(self, request, timeout=None, **kwargs):
+		return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
 class PyUntisSession:
 	SCHOOLQUERY_URL = "https://query.webuntis.com/schoolquery?m=searchSchool&v=i2.5.2"
 	JSON_API_FORMAT = "https://{0}/WebUntis/jsonrpc.do{1}"
@@ -20,13 +88,76 @@ class PyUntisSession:
 # 	USER_AGENT = "PyUntis 3.0"
 	USER_AGENT = "Untis/2.5.2 (at.grupet.mobile.um; build:1; iOS 13.0.0) Alamofire/4.8.1"
 	
-	def __init__(self):
+	# Master data rarely changes, so targeted runs can reuse what the last full run fetched
+	MASTER_DATA_METHODS = {
+		"searchSchool", "getCurrentSchoolyear", "getSchoolyears", "getHolidays", "getTimegridUnits",
+		"getKlassen", "getTeachers", "getSubjects", "getRooms", "getDepartments", "getExamTypes"
+	}
+	
+	# These change the session's state, so they're always sent
+	UNMEMOIZED_METHODS = {"authenticate", "logout"}
+	
+	# transport can contain the keys poolSize, connectTimeout, readTimeout and compress, see README.md
+	def __init__(self, transport=None, memo_ttl=None):
+		transport = transport or {}
+		timeout = (transport.get("connectTimeout", 10), transport.get("readTimeout", 120))
+		
 		self.session = requests.Session()
-		self.session.headers = { "User-Agent": self.USER_AGENT, "Content-Type": "application/json;charset=UTF-8", "Cache-Control": "no-cache" }
+		self.session.headers = {
+			"User-Agent": self.USER_AGENT, "Content-Type": "application/json;charset=UTF-8", "Cache-Control": "no-cache",
+			"Accept-Encoding": "gzip, deflate" if transport.get("compress", True) else "identity", "Connection": "keep-alive"
+		}
+		
+		# School searches go to a different host than everything else, so they get a pool of their own
+		self.api_adapter = PyUntisTransportAdapter(transport.get("poolSize", 4), timeout)
+		self.query_adapter = PyUntisTransportAdapter(1, timeout)
+		self.session.mount("https://", self.api_adapter)
+		self.session.mount("https://query.webuntis.com/", self.query_adapter)
 		
 		self.servername = ""
 		self.requestID = 0
 		
+		# Every master data response is recorded here, but only answered from here with use_master_cache
+		self.master_cache = {}
+		self.use_master_cache = False
+		
+		# Identical master data requests are only sent once per login (or per memo_ttl seconds, if set).
+		# Identical requests that are still running are shared, so concurrent callers wait for the same response.
+		self.memo_ttl = memo_ttl
+		self.memo_hits = 0
+		self._memo = {}
+		self._memo_lock = threading.Lock()
+		
+	def load_master_cache(self, path):
+		try:
+			with open(path, "r", encoding="utf-8") as cache_file:
+				self.master_cache = json.load(cache_file)
+		except (FileNotFoundError, ValueError):
+			self.master_cache = {}
+			
+	def save_master_cache(self, path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w", encoding="utf-8") as cache_file:
+			json.dump(self.master_cache, cache_file, ensure_ascii=False)
+			
+	def _master_cache_key(self, payload):
+		if payload["method"] not in self.MASTER_DATA_METHODS:
+			return None
+			
+		return json.dumps([self.servername, payload["method"], payload.get("params")], sort_keys=True)
+		
+	def transport_stats(self):
+		adapters = [self.api_adapter, self.query_adapter]
+		request_count = sum(adapter.request_count for adapter in adapters)
+		connection_count = sum(adapter.connection_count for adapter in adapters)
+		
+		return {"requests": request_count, "connections": connection_count, "reused": max(request_count - connection_count, 0)}
+		
+	def clear_memo(self):
+		with self._memo_lock:
+			self._memo = {}
+			self.memo_hits = 0
+			
 	def _build_payload(self, method, shitty_untis_api_hack=False, **params):
 		self.requestID += 1
 		
@@ -39,19 +170,77 @@ class PyUntisSession:
 		
 	def searchSchools(self, searchString):
 		payload = self._build_payload("searchSchool", shitty_untis_api_hack=False, search = searchString)
-
-		print(payload)
-		
-		r = self.session.post(self.SCHOOLQUERY_URL, json = payload)
-		response = r.json()
+		cache_key = self._master_cache_key(payload)
 		
-		if "error" in response:
-			raise PyUntisError(response["error"])
+		if self.use_master_cache and cache_key in self.master_cache:
+			schools = self.master_cache[cache_key]
+		else:
+			print(payload)
 			
-		schools = response["result"]["schools"]
-		return [PyUntisSchool.from_json(s) for s in schools]
+			r = self.session.post(self.SCHOOLQUERY_URL, json = payload)
+			response = r.json()
 			
+			if "error" in response:
+				raise PyUntisError(response["error"])
+				
+			schools = response["result"]["schools"]
+			self.master_cache[cache_key] = schools
+			
+		return [PyUntisSchool.from_json(s) for s in schools]
+		
 	def _post(self, payload, **url_params):
+		cache_key = self._master_cache_key(payload)
+		if self.use_master_cache and cache_key in self.master_cache:
+			return self.master_cache[cache_key]
+			
+		result = self._memoized_send(payload, **url_params)
+		if cache_key and result is not None and result != []:
+			self.master_cache[cache_key] = result
+			
+		return result
+			
+	def _memoized_send(self, payload, **url_params):
+		if payload["method"] in self.UNMEMOIZED_METHODS:
+			return self._send(payload, **url_params)
+			
+		# The request ID doesn't change the response, so it's not part of the key
+		memo_key = json.dumps([self.servername, url_params, payload["method"], payload.get("params")], sort_keys=True)
+		
+		with self._memo_lock:
+			memo = self._memo.get(memo_key)
+			if memo and (self.memo_ttl is None or time.monotonic() - memo[1] < self.memo_ttl):
+				self.memo_hits += 1
+				return_shared = True
+			else:
+				memo = (Future(), time.monotonic())
+				self._memo[memo_key] = memo
+				return_shared = False
+				
+		if return_shared:
+			return memo[0].result()
+			
+		try:
+			result = self._send(payload, **url_params)
+		except BaseException as e:
+			# Failed requests aren't remembered, the next caller tries again
+			self._forget(memo_key, memo)
+			memo[0].set_exception(e)
+			raise
+			
+		# Only master data is kept around. Everything else, like timetables, can be big and is only
+		# shared while it's being requested, so it can be dropped as soon as it has been parsed.
+		if payload["method"] not in self.MASTER_DATA_METHODS:
+			self._forget(memo_key, memo)
+			
+		memo[0].set_result(result)
+		return result
+		
+	def _forget(self, memo_key, memo):
+		with self._memo_lock:
+			if self._memo.get(memo_key) is memo:
+				del self._memo[memo_key]
+		
+	def _send(self, payload, **url_params):
 		json_api_url = self.JSON_API_FORMAT.format(self.servername, "?" + urlencode(url_params) if url_params else "")
 
 		# print(json_api_url, payload)
@@ -70,6 +259,7 @@ class PyUntisSession:
 		
 	def authenticate(self, school, username, password=None):
 		self.servername = school.server
+		self.clear_memo()
 		payload = self._build_payload("authenticate", user=username, password=password, client=self.USER_AGENT)
 		response = self._post(payload, school = school.login_name)
 		
@@ -78,6 +268,7 @@ class PyUntisSession:
 	def logout(self):
 		payload = self._build_payload("logout")
 		self._post(payload)
+		self.clear_memo()
 		# This is a fire-and-forget method without any output
 		
 	def getTeachers(self):
@@ -156,7 +347,14 @@ class PyUntisSession:
 		return [PyUntisTimetableEntry(t) for t in response]
 		
 	def getTimetableCustom(self, id, type, start_date=None, end_date=None, keyType="id", **params):
-		fields = params["fields"] if "fields" in params else ["id", "name", "longname"]
+		response = self.getTimetableRaw(id, type, start_date=start_date, end_date=end_date, keyType=keyType, **params)
+		
+		return [PyUntisTimetableEntry(t) for t in response]
+		
+	# Same as getTimetableCustom, but returns the unparsed entries.
+	# Useful for deduplicating lessons that are returned for several elements before parsing them.
+	def getTimetableRaw(self, id, type, start_date=None, end_date=None, keyType="id", **params):
+		fields = params.pop("fields", None) or ["id", "name", "longname"]
 		element = {"id": id, "type": type, "keyType": keyType}
 		params = { k:v for k,v in params.items() if v is not None }
 		options = {
@@ -164,10 +362,9 @@ class PyUntisSession:
 			"klasseFields": fields, "roomFields": fields, "subjectFields": fields, "teacherFields": fields,
 			**params
 		}
-		payload = self._build_payload("getTimetable", options=options)        
-		response = self._post(payload)
+		payload = self._build_payload("getTimetable", options=options)
 		
-		return [PyUntisTimetableEntry(t) for t in response]
+		return self._post(payload) or []
 		
 	def getLatestImportTime(self):
 		payload = self._build_payload("getLatestImportTime")
@@ -176,19 +373,23 @@ class PyUntisSession:
 		return datetime.fromtimestamp(response / 1000.0)
 		
 	def getSubstitutions(self, start_date=None, end_date=None, department_id=0):
-		payload = self._build_payload("getSubstitutions", startDate = start_date, endDate=end_date, departmentId=department_id)
-		response = self._post(payload)
+		response = self.getSubstitutionsRaw(start_date=start_date, end_date=end_date, department_id=department_id)
 		
 		return [PyUntisSubstitution(subst) for subst in response]
 		
-	def getExams(self, exam_type_id, start_date, end_date):
-		payload = self._build_payload("getExams", examTypeId=exam_type_id, startDate=start_date, endDate=end_date)
-		response = self._post(payload)
+	def getSubstitutionsRaw(self, start_date=None, end_date=None, department_id=0):
+		payload = self._build_payload("getSubstitutions", startDate = start_date, endDate=end_date, departmentId=department_id)
 		
-		return response
+		return self._post(payload) or []
+		
+	def getExams(self, exam_type, start_date, end_date):
+		payload = self._build_payload("getExams", examTypeId=exam_type.id, startDate=start_date, endDate=end_date)
+		response = self._post(payload) or []
+		
+		return [PyUntisExam(e, exam_type) for e in response]
 		
 	def getExamTypes(self):
 		payload = self._build_payload("getExamTypes")
-		response = self._post(payload)
+		response = self._post(payload) or []
 		
-		return response
\ No newline at end of file
+		return [PyUntisExamType(et) for et in response]
\ No newline at end of file
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import json
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+from PyUntisClasses import *
+
+# Append-only local store of the lessons and substitutions fetched in every run.
+# A row is only added if an entry is new, its contents changed or it disappeared,
+# so the store only grows by the amount of data that actually changed.
+# The latest row of each entry is its current state, rows with a hash of NULL mark removed entries.
+class PyUntisStore:
+	SCHEMA = """
+		CREATE TABLE IF NOT EXISTS runs (
+			run_id INTEGER PRIMARY KEY,
+			school TEXT NOT NULL,
+			started TEXT NOT NULL,
+			start_date TEXT NOT NULL,
+			end_date TEXT NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS runs_school_started ON runs (school, started);
+
+		CREATE TABLE IF NOT EXISTS entries (
+			row_id INTEGER PRIMARY KEY,
+			run_id INTEGER NOT NULL REFERENCES runs (run_id),
+			school TEXT NOT NULL,
+			kind TEXT NOT NULL,
+			entry_key TEXT NOT NULL,
+			hash TEXT,
+			date TEXT NOT NULL,
+			start_time INTEGER NOT NULL,
+			data TEXT
+		);
+		CREATE INDEX IF NOT EXISTS entries_key ON entries (school, kind, entry_key, row_id);
+		CREATE INDEX IF NOT EXISTS entries_date ON entries (school, kind, date);
+		CREATE INDEX IF NOT EXISTS entries_run ON entries (run_id);
+
+		CREATE TABLE IF NOT EXISTS entry_elements (
+			row_id INTEGER NOT NULL REFERENCES entries (row_id),
+			element_type INTEGER NOT NULL,
+			element_id INTEGER NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS entry_elements_element ON entry_elements (element_type, element_id, row_id);
+		CREATE INDEX IF NOT EXISTS entry_elements_row ON entry_elements (row_id);
+	"""
+
+	LESSON = "lesson"
+	SUBSTITUTION = "substitution"
+
+	# Keys of the raw API objects that list the classes, teachers and rooms of an entry
+	ELEMENT_KEYS = {
+		"kl": PyUntisElementType.CLASS,
+		"te": PyUntisElementType.TEACHER,
+		"ro": PyUntisElementType.ROOM
+	}
+
+	def __init__(self, path):
+		# Runs write from the pipeline's threads, so access to the connection is serialized with a lock
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.row_factory = sqlite3.Row
+		self.lock = threading.Lock()
+
+		with self.lock:
+			self.connection.executescript(self.SCHEMA)
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+	def begin_run(self, school, start_date, end_date):
+		return PyUntisStoreRun(self, school, start_date, end_date)
+
+	# Returns the latest hash of every entry in the given date range that hasn't been removed
+	def latest_hashes(self, school, kind, start_date, end_date):
+		with self.lock:
+			rows = self.connection.execute("""
+				SELECT entry_key, hash FROM entries
+				WHERE row_id IN (
+					SELECT MAX(row_id) FROM entries
+					WHERE school = ? AND kind = ? AND date BETWEEN ? AND ?
+					GROUP BY entry_key
+				) AND hash IS NOT NULL
+			""", (school, kind, start_date.untis_date, end_date.untis_date)).fetchall()
+
+		return {row["entry_key"]: row["hash"] for row in rows}
+
+	# Returns all changes recorded since the given datetime, oldest first.
+	# Removed entries have a data value of None.
+	def changes_since(self, school, since, kind=None):
+		query = """
+			SELECT entries.kind, entries.entry_key, entries.date, entries.data, runs.started FROM entries
+			JOIN runs ON runs.run_id = entries.run_id
+			WHERE entries.school = ? AND runs.started >= ?
+		"""
+		params = [school, since.strftime("%Y-%m-%d %H:%M:%S")]
+		if kind:
+			query += " AND entries.kind = ?"
+			params.append(kind)
+
+		with self.lock:
+			rows = self.connection.execute(query + " ORDER BY entries.row_id", params).fetchall()
+
+		return [{
+			"kind": row["kind"],
+			"key": row["entry_key"],
+			"date": row["date"],
+			"data": json.loads(row["data"]) if row["data"] else None,
+			"changed": row["started"]
+		} for row in rows]
+
+	# Returns the raw entries of a day as they were at the given datetime (or now),
+	# optionally only those of a single class, teacher or room.
+	def entries_on(self, school, date, kind=LESSON, element_type=None, element_id=None, as_of=None):
+		query = """
+			SELECT entries.data FROM entries
+			WHERE entries.row_id IN (
+				SELECT MAX(entries.row_id) FROM entries
+				JOIN runs ON runs.run_id = entries.run_id
+				WHERE entries.school = ? AND entries.kind = ? AND entries.date = ? AND runs.started <= ?
+				GROUP BY entries.entry_key
+			) AND entries.hash IS NOT NULL
+		"""
+		params = [school, kind, date.untis_date, (as_of or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")]
+		if element_type is not None:
+			query += " AND entries.row_id IN (SELECT row_id FROM entry_elements WHERE element_type = ? AND element_id = ?)"
+			params += [element_type, element_id]
+
+		with self.lock:
+			rows = self.connection.execute(query + " ORDER BY entries.start_time", params).fetchall()
+
+		return [json.loads(row["data"]) for row in rows]
+
+# Records the entries of a single run.
+# Nothing is written to the store until finish() is called, so failed runs don't leave anything behind.
+class PyUntisStoreRun:
+	def __init__(self, store, school, start_date, end_date):
+		self.store = store
+		self.school = school
+
+		self.previous_hashes = {
+			kind: store.latest_hashes(school, kind, start_date, end_date)
+			for kind in [PyUntisStore.LESSON, PyUntisStore.SUBSTITUTION]
+		}
+		self.seen_keys = {kind: set() for kind in self.previous_hashes}
+		self.substitution_key_counts = {}
+
+		with store.lock:
+			cursor = store.connection.execute("INSERT INTO runs (school, started, start_date, end_date) VALUES (?, ?, ?, ?)",
+				(school, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), start_date.untis_date, end_date.untis_date))
+			self.run_id = cursor.lastrowid
+
+	def _add(self, kind, entry_key, raw_json):
+		data = json.dumps(raw_json, ensure_ascii=False, sort_keys=True)
+		data_hash = hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+		self.seen_keys[kind].add(entry_key)
+		if self.previous_hashes[kind].get(entry_key) == data_hash:
+			return # unchanged
+
+		with self.store.lock:
+			cursor = self.store.connection.execute("""
+				INSERT INTO entries (run_id, school, kind, entry_key, hash, date, start_time, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+			""", (self.run_id, self.school, kind, entry_key, data_hash, str(raw_json["date"]), raw_json["startTime"], data))
+
+			self.store.connection.executemany("INSERT INTO entry_elements (row_id, element_type, element_id) VALUES (?, ?, ?)", [
+				(cursor.lastrowid, element_type, el["id"])
+				for key, element_type in PyUntisStore.ELEMENT_KEYS.items()
+				for el in raw_json.get(key, [])
+			])
+
+	def add_lesson(self, raw_entry):
+		self._add(PyUntisStore.LESSON, str(raw_entry["id"]), raw_entry)
+
+	# Substitutions don't have IDs of their own, so they're identified by their lesson, date, time, type
+	# and the classes, teachers and rooms involved, since one lesson can have several substitutions at once.
+	# Substitutions that are identical in all of these are told apart by the order they were returned in.
+	def add_substitution(self, raw_subst):
+		element_ids = [
+			",".join(sorted("{0}/{1}".format(el["id"], el.get("orgid", "")) for el in raw_subst.get(key, [])))
+			for key in PyUntisStore.ELEMENT_KEYS
+		]
+		subst_key = ":".join(str(part) for part in [raw_subst["lsid"], raw_subst["date"], raw_subst["startTime"], raw_subst["type"]] + element_ids)
+
+		occurrence = self.substitution_key_counts.get(subst_key, 0)
+		self.substitution_key_counts[subst_key] = occurrence + 1
+		if occurrence:
+			subst_key += "#{0}".format(occurrence)
+
+		self._add(PyUntisStore.SUBSTITUTION, subst_key, raw_subst)
+
+	# Call this if not all entries of a kind could be fetched, so missing ones aren't marked as removed
+	def mark_incomplete(self, kind):
+		self.seen_keys[kind] |= self.previous_hashes[kind].keys()
+
+	# Marks entries that were there in the previous run but are gone now as removed and commits the run
+	def finish(self):
+		with self.store.lock:
+			for kind, previous_hashes in self.previous_hashes.items():
+				removed_keys = previous_hashes.keys() - self.seen_keys[kind]
+				self.store.connection.executemany("""
+					INSERT INTO entries (run_id, school, kind, entry_key, hash, date, start_time, data)
+					SELECT ?, school, kind, entry_key, NULL, date, start_time, NULL FROM entries
+					WHERE row_id = (SELECT MAX(row_id) FROM entries WHERE school = ? AND kind = ? AND entry_key = ?)
+				""", [(self.run_id, self.school, kind, key) for key in removed_keys])
+
+			self.store.connection.commit()
+
+	def abort(self):
+		with self.store.lock:
+			self.store.connection.rollback()